@@ -0,0 +1,176 @@
+# Archivado de tareas completadas (tabla caliente "tasks" -> tabla fría "tasks_archive")
+from sqlmodel import Session, select
+from sqlalchemy import DateTime, and_, delete, insert, literal
+from dotenv import load_dotenv
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+import logging
+import os
+import threading
+from .database import engine
+from .models import Task, TaskArchive
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Configuración del archivado
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# Cada cuántos segundos se ejecuta el hilo de archivado dentro de la API (0 lo desactiva).
+# Por defecto está desactivado: el worker de jobs (python -m src.jobs) encola el job
+# "archive" cada JOB_ARCHIVE_INTERVAL_SECONDS y lo ejecuta fuera de los procesos de la API.
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "0"))
+# Fichero de bloqueo para que solo un proceso (p. ej. un worker de uvicorn) ejecute el job
+ARCHIVE_LOCK_FILE = os.getenv("ARCHIVE_LOCK_FILE", "archive.lock")
+
+logger = logging.getLogger(__name__)
+
+# Evento para detener el hilo en segundo plano (solo existe mientras hay un hilo)
+_stop_event: Optional[threading.Event] = None
+
+# Fichero bloqueado por el proceso que ejecuta el job
+_lock_handle = None
+
+
+# Condición de una tarea archivable
+def _archivable(cutoff: datetime):
+    return and_(Task.is_completed == True, Task.created_at < cutoff)  # noqa: E712
+
+
+# Elegir los IDs del siguiente lote. En MySQL las filas quedan bloqueadas hasta el commit
+# y otro archivador concurrente se salta las bloqueadas (SKIP LOCKED).
+def select_archivable_ids(session: Session, cutoff: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> List[int]:
+    return session.exec(
+        select(Task.id)
+        .where(_archivable(cutoff))
+        .order_by(Task.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+
+# Copiar y borrar las tareas en la misma transacción. Ambas sentencias vuelven a
+# comprobar la condición y copian las filas tal como están en la BD en ese momento,
+# así un update_task concurrente no se pierde y dos archivadores no duplican filas.
+def move_tasks(session: Session, ids: List[int], cutoff: datetime) -> int:
+    guard = and_(Task.id.in_(ids), _archivable(cutoff))
+    columns = [Task.id, Task.title, Task.description, Task.is_completed, Task.user_id, Task.created_at]
+    session.exec(
+        insert(TaskArchive).from_select(
+            [column.key for column in columns] + ["archived_at"],
+            select(*columns, literal(datetime.now(), DateTime)).where(guard)
+        )
+    )
+    moved = session.exec(delete(Task).where(guard)).rowcount
+    session.commit()
+    return moved
+
+
+# Mover un lote de tareas completadas anteriores a "cutoff". Devuelve cuántas se movieron.
+# Cada lote es una transacción: si el proceso se corta, el siguiente lote retoma donde quedó.
+def archive_batch(session: Session, cutoff: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    ids = select_archivable_ids(session, cutoff, batch_size)
+    if not ids:
+        session.rollback()
+        return 0
+    return move_tasks(session, ids, cutoff)
+
+
+# Archivar todas las tareas completadas con más de "older_than_days" días, por lotes.
+# "progress" recibe el total de tareas movidas tras cada lote.
+def archive_completed_tasks(
+    session: Session,
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    max_batches: Optional[int] = None,
+    stop_event: Optional[threading.Event] = None,
+    progress: Optional[Callable[[int], None]] = None
+) -> int:
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        if stop_event is not None and stop_event.is_set():
+            break
+        moved = archive_batch(session, cutoff, batch_size)
+        total += moved
+        batches += 1
+        if progress is not None:
+            progress(total)
+        if moved < batch_size:
+            break
+    return total
+
+
+# Bucle del job en segundo plano
+def _archive_loop(interval: float, stop_event: threading.Event) -> None:
+    while not stop_event.wait(interval):
+        try:
+            with Session(engine) as session:
+                moved = archive_completed_tasks(session, stop_event=stop_event)
+            if moved:
+                logger.info("Tareas archivadas: %s", moved)
+        except Exception:
+            logger.exception("Error archivando tareas")
+
+
+# Intentar ser el único proceso que archiva (los demás workers de uvicorn no lo inician)
+def _acquire_process_lock(path: str) -> bool:
+    global _lock_handle
+    if fcntl is None:
+        return True
+    handle = open(path, "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _lock_handle = handle
+    return True
+
+
+def _release_process_lock() -> None:
+    global _lock_handle
+    if _lock_handle is not None:
+        _lock_handle.close()
+        _lock_handle = None
+
+
+# Iniciar el job de archivado (si está activado y ningún otro proceso lo tiene)
+def start_archive_worker(
+    interval: float = ARCHIVE_INTERVAL_SECONDS, lock_file: str = ARCHIVE_LOCK_FILE
+) -> Optional[threading.Thread]:
+    global _stop_event
+    if interval <= 0:
+        return None
+    if not _acquire_process_lock(lock_file):
+        logger.info("Otro proceso ya ejecuta el archivado")
+        return None
+    _stop_event = threading.Event()
+    thread = threading.Thread(
+        target=_archive_loop, args=(interval, _stop_event), name="task-archiver", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+# Detener el job de archivado
+def stop_archive_worker(thread: Optional[threading.Thread]) -> None:
+    global _stop_event
+    if thread is None or _stop_event is None:
+        return
+    _stop_event.set()
+    thread.join(timeout=5)
+    _stop_event = None
+    _release_process_lock()
+
+
+# Ejecutar el archivado una vez desde la línea de comandos: python -m src.archive
+if __name__ == "__main__":
+    with Session(engine) as session:
+        print(f"Tareas archivadas: {archive_completed_tasks(session)}")
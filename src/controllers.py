@@ -1,24 +1,87 @@
 # Controladores (Routers) - Endpoints de la API
-from fastapi import APIRouter, Depends, status
-from sqlmodel import Session
-from typing import List
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from sqlmodel import Session, SQLModel
+from typing import Any, Callable, List, Optional, Type
+from dotenv import load_dotenv
+import hmac
+import os
 from .database import get_session
-from .models import UserCreate, UserRead, TaskCreate, TaskRead, TaskUpdate
-from . import services
+from .idempotency import IDEMPOTENCY_MAX_KEY_LENGTH, idempotency_store, fingerprint
+from .models import UserCreate, UserRead, TaskCreate, TaskRead, TaskUpdate, JobCreate, JobRead
+from .profiling import ProfiledRoute
+from . import services, jobs
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Token para los endpoints de administración (vacío = desactivados)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 # Router para usuarios
-user_router = APIRouter(prefix="/users", tags=["Users"])
+user_router = APIRouter(prefix="/users", tags=["Users"], route_class=ProfiledRoute)
 
 # Router para tareas
-task_router = APIRouter(prefix="/tasks", tags=["Tasks"])
+task_router = APIRouter(prefix="/tasks", tags=["Tasks"], route_class=ProfiledRoute)
+
+
+# Verificar la cabecera X-Admin-Token
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Token de administración inválido"
+        )
+
+
+# Router de administración
+admin_router = APIRouter(
+    prefix="/admin", tags=["Admin"], dependencies=[Depends(require_admin)], route_class=ProfiledRoute
+)
+
+# Router de jobs (también requiere el token de administración)
+job_router = APIRouter(
+    prefix="/jobs", tags=["Jobs"], dependencies=[Depends(require_admin)], route_class=ProfiledRoute
+)
+
+
+# Ejecutar una creación respetando la cabecera Idempotency-Key.
+# La primera respuesta se guarda ya serializada, así los reintentos no tocan la BD.
+def run_idempotent(scope: str, idempotency_key: Optional[str], payload: SQLModel,
+                   read_model: Type[SQLModel], response: Response,
+                   operation: Callable[[], Any]) -> Any:
+    if not idempotency_key:
+        return operation()
+    if len(idempotency_key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"La Idempotency-Key no puede superar {IDEMPOTENCY_MAX_KEY_LENGTH} caracteres"
+        )
+
+    result, replayed = idempotency_store.run(
+        scope,
+        idempotency_key,
+        fingerprint(payload),
+        lambda: read_model.model_validate(operation())
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
 
 
 # ============ ENDPOINTS DE USUARIOS ============
 
 # Crear un usuario
 @user_router.post("/", response_model=UserRead, status_code=status.HTTP_201_CREATED)
-def create_user(user: UserCreate, session: Session = Depends(get_session)):
-    return services.create_user(user, session)
+def create_user(
+    user: UserCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    session: Session = Depends(get_session)
+):
+    return run_idempotent(
+        "POST /users/", idempotency_key, user, UserRead, response,
+        lambda: services.create_user(user, session)
+    )
 
 
 # Listar todos los usuarios
@@ -35,16 +98,26 @@ def get_user(user_id: int, session: Session = Depends(get_session)):
 
 # Obtener las tareas de un usuario
 @user_router.get("/{user_id}/tasks", response_model=List[TaskRead])
-def get_user_tasks(user_id: int, session: Session = Depends(get_session)):
-    return services.list_user_tasks(user_id, session)
+def get_user_tasks(
+    user_id: int, include_archived: bool = False, session: Session = Depends(get_session)
+):
+    return services.list_user_tasks(user_id, session, include_archived)
 
 
 # ============ ENDPOINTS DE TAREAS ============
 
 # Crear una tarea
 @task_router.post("/", response_model=TaskRead, status_code=status.HTTP_201_CREATED)
-def create_task(task: TaskCreate, session: Session = Depends(get_session)):
-    return services.create_task(task, session)
+def create_task(
+    task: TaskCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    session: Session = Depends(get_session)
+):
+    return run_idempotent(
+        "POST /tasks/", idempotency_key, task, TaskRead, response,
+        lambda: services.create_task(task, session)
+    )
 
 
 # Obtener una tarea por ID
@@ -64,3 +137,32 @@ def update_task(task_id: int, task: TaskUpdate, session: Session = Depends(get_s
 def delete_task(task_id: int, session: Session = Depends(get_session)):
     services.delete_task(task_id, session)
     return None
+
+
+# ============ ENDPOINTS DE ADMINISTRACIÓN ============
+
+# Exportar users y tasks a Parquet / Arrow IPC para analítica.
+# La exportación se encola como job "snapshot" y la ejecuta el worker (python -m src.jobs).
+@admin_router.post("/snapshots", response_model=JobRead, status_code=status.HTTP_202_ACCEPTED)
+def create_snapshot(
+    format: str = "parquet",
+    incremental: bool = False,
+    tables: Optional[List[str]] = Query(default=None),
+    session: Session = Depends(get_session)
+):
+    job = JobCreate(kind="snapshot", params={"format": format, "incremental": incremental, "tables": tables})
+    return jobs.job_to_read(jobs.enqueue_job(job, session))
+
+
+# ============ ENDPOINTS DE JOBS ============
+
+# Encolar un job (lo ejecuta el worker: python -m src.jobs)
+@job_router.post("/", response_model=JobRead, status_code=status.HTTP_202_ACCEPTED)
+def create_job(job: JobCreate, session: Session = Depends(get_session)):
+    return jobs.job_to_read(jobs.enqueue_job(job, session))
+
+
+# Consultar el estado, progreso y resultado de un job
+@job_router.get("/{job_id}", response_model=JobRead)
+def get_job(job_id: int, session: Session = Depends(get_session)):
+    return jobs.job_to_read(jobs.get_job(job_id, session))
@@ -0,0 +1,126 @@
+# Soporte de Idempotency-Key para los endpoints POST
+from collections import OrderedDict
+from fastapi import HTTPException, status
+from dotenv import load_dotenv
+from typing import Any, Callable, Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Configuración del almacén (máximo de claves y tiempo de vida en segundos)
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+# Tiempo máximo que espera un duplicado concurrente a la primera petición
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+
+# Longitud máxima de la clave: se guarda tal cual durante el TTL
+IDEMPOTENCY_MAX_KEY_LENGTH = int(os.getenv("IDEMPOTENCY_MAX_KEY_LENGTH", "255"))
+
+
+# Calcular una huella del cuerpo de la petición para detectar reutilización de claves
+def fingerprint(payload: Any) -> str:
+    if hasattr(payload, "model_dump"):
+        payload = payload.model_dump(mode="json")
+    data = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+# Almacén LRU en memoria con TTL y control de peticiones en curso
+class IdempotencyStore:
+    def __init__(self, max_keys: int = IDEMPOTENCY_MAX_KEYS, ttl: float = IDEMPOTENCY_TTL_SECONDS):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # clave -> (huella, respuesta, instante de expiración)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, Any, float]]" = OrderedDict()
+        # clave -> (huella, evento que se activa al terminar la primera petición)
+        self._in_flight: Dict[Tuple[str, str], Tuple[str, threading.Event]] = {}
+
+    # Buscar una respuesta guardada (sin bloquear), eliminando las expiradas
+    def _lookup(self, key: Tuple[str, str], now: float) -> Optional[Tuple[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    # Guardar una respuesta y expulsar las más antiguas si se supera el límite
+    def _save(self, key: Tuple[str, str], request_hash: str, response: Any) -> None:
+        self._entries[key] = (request_hash, response, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    # Ejecutar la operación una sola vez por clave; devuelve (respuesta, es_repetición)
+    def run(self, scope: str, idempotency_key: str, request_hash: str,
+            operation: Callable[[], Any]) -> Tuple[Any, bool]:
+        key = (scope, idempotency_key)
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            with self._lock:
+                found = self._lookup(key, time.monotonic())
+                if found is not None:
+                    stored_hash, response = found
+                    _check_same_request(stored_hash, request_hash)
+                    return response, True
+
+                pending = self._in_flight.get(key)
+                if pending is None:
+                    event = threading.Event()
+                    self._in_flight[key] = (request_hash, event)
+                    break
+                _check_same_request(pending[0], request_hash)
+
+            # Otra petición con la misma clave está en curso: esperar a que termine
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not pending[1].wait(remaining):
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="Hay una petición en curso con la misma Idempotency-Key"
+                )
+
+        # Primera petición con esta clave: ejecutar la operación
+        try:
+            response = operation()
+        except BaseException:
+            # Si falla no se guarda nada, así un reintento puede volver a intentarlo
+            with self._lock:
+                self._in_flight.pop(key, None)
+            event.set()
+            raise
+
+        with self._lock:
+            self._save(key, request_hash, response)
+            self._in_flight.pop(key, None)
+        event.set()
+        return response, False
+
+    # Vaciar el almacén
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# La misma clave no puede reutilizarse con un cuerpo distinto
+def _check_same_request(stored_hash: str, request_hash: str) -> None:
+    if stored_hash != request_hash:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="La Idempotency-Key ya se usó con una petición distinta"
+        )
+
+
+# Instancia compartida por toda la aplicación
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,375 @@
+# Cola de jobs para operaciones pesadas (exportaciones, archivado, borrados grandes)
+#
+# Los jobs se guardan en la tabla "jobs" de la misma BD, así la cola es persistente
+# sin infraestructura extra. La API solo encola; el worker (python -m src.jobs)
+# reclama jobs pendientes y ejecuta cada uno en su propio proceso.
+from sqlmodel import Field, Session, SQLModel, select
+from sqlalchemy import delete, func, update
+from fastapi import HTTPException, status
+from pydantic import ValidationError, field_validator
+from concurrent.futures import Future, ProcessPoolExecutor
+from dotenv import load_dotenv
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Type
+import argparse
+import json
+import logging
+import os
+import time
+from .database import engine
+from .models import Job, JobCreate, JobRead, Task, TaskArchive, User
+from .archive import ARCHIVE_AFTER_DAYS, archive_completed_tasks
+from .snapshot import SNAPSHOT_TABLES, export_table
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Configuración del worker
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+JOB_DELETE_BATCH_SIZE = int(os.getenv("JOB_DELETE_BATCH_SIZE", "1000"))
+# Cada cuánto el worker renueva el heartbeat de sus jobs, y tras cuánto sin heartbeat
+# un job "running" se considera huérfano (worker caído o redesplegado)
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Intentos máximos antes de marcar como fallido un job cuyo proceso se cae
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Cada cuántos segundos el worker encola el job "archive" (0 lo desactiva)
+JOB_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("JOB_ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+logger = logging.getLogger(__name__)
+
+# Tipo de la función para informar el progreso (0.0 a 1.0)
+Report = Callable[[float], None]
+
+
+# ============ PARÁMETROS DE JOBS ============
+
+# Parámetros del job "snapshot" (los mismos que POST /admin/snapshots)
+class SnapshotJobParams(SQLModel):
+    format: Literal["parquet", "arrow"] = "parquet"
+    incremental: bool = False
+    tables: Optional[List[str]] = None
+
+    @field_validator("tables")
+    @classmethod
+    def check_tables(cls, tables: Optional[List[str]]) -> Optional[List[str]]:
+        unknown = [table for table in tables or [] if table not in SNAPSHOT_TABLES]
+        if unknown:
+            raise ValueError(f"Tablas desconocidas: {', '.join(unknown)}")
+        return tables
+
+
+# Parámetros del job "archive"
+class ArchiveJobParams(SQLModel):
+    older_than_days: int = Field(default=ARCHIVE_AFTER_DAYS, ge=0)
+
+
+# Parámetros del job "delete_user_tasks"
+class DeleteUserTasksJobParams(SQLModel):
+    user_id: int
+
+
+# ============ HANDLERS DE JOBS ============
+
+# Exportar snapshots
+def snapshot_job(session: Session, params: SnapshotJobParams, report: Report) -> Dict[str, Any]:
+    tables = params.tables or list(SNAPSHOT_TABLES)
+    files = []
+    for index, table in enumerate(tables):
+        files.append(export_table(session, table, params.format, params.incremental))
+        report((index + 1) / len(tables))
+    return {"files": files}
+
+
+# Archivar las tareas completadas antiguas
+def archive_job(session: Session, params: ArchiveJobParams, report: Report) -> Dict[str, Any]:
+    cutoff = datetime.now() - timedelta(days=params.older_than_days)
+    total = session.exec(
+        select(func.count()).select_from(Task)
+        .where(Task.is_completed == True)  # noqa: E712
+        .where(Task.created_at < cutoff)
+    ).one()
+
+    moved = archive_completed_tasks(
+        session, params.older_than_days, progress=lambda moved: report(moved / total if total else 1.0)
+    )
+    return {"archived": moved}
+
+
+# Borrar todas las tareas de un usuario (incluidas las archivadas) por lotes
+def delete_user_tasks_job(session: Session, params: DeleteUserTasksJobParams, report: Report) -> Dict[str, Any]:
+    user_id = params.user_id
+    if not session.get(User, user_id):
+        raise ValueError("Usuario no encontrado")
+
+    total = sum(
+        session.exec(select(func.count()).select_from(model).where(model.user_id == user_id)).one()
+        for model in (Task, TaskArchive)
+    )
+    deleted = 0
+    for model in (Task, TaskArchive):
+        while True:
+            ids = session.exec(
+                select(model.id).where(model.user_id == user_id).limit(JOB_DELETE_BATCH_SIZE)
+            ).all()
+            if not ids:
+                break
+            session.exec(delete(model).where(model.id.in_(ids)))
+            session.commit()
+            deleted += len(ids)
+            report(deleted / total if total else 1.0)
+    return {"deleted": deleted}
+
+
+# Tipos de job disponibles: modelo de parámetros y handler
+JOB_KINDS: Dict[str, Tuple[Type[SQLModel], Callable[[Session, Any, Report], Dict[str, Any]]]] = {
+    "snapshot": (SnapshotJobParams, snapshot_job),
+    "archive": (ArchiveJobParams, archive_job),
+    "delete_user_tasks": (DeleteUserTasksJobParams, delete_user_tasks_job),
+}
+
+
+# ============ SERVICIOS DE JOBS ============
+
+# Convertir un Job (con JSON en texto) al schema de lectura
+def job_to_read(job: Job) -> JobRead:
+    return JobRead(
+        id=job.id,
+        kind=job.kind,
+        params=json.loads(job.params),
+        status=job.status,
+        progress=job.progress,
+        attempts=job.attempts,
+        result=json.loads(job.result) if job.result else None,
+        error=job.error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
+    )
+
+
+# Encolar un job nuevo
+def enqueue_job(job_data: JobCreate, session: Session) -> Job:
+    if job_data.kind not in JOB_KINDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Tipo de job desconocido: {job_data.kind}"
+        )
+
+    # Validar los parámetros con el modelo del tipo de job y guardarlos normalizados
+    params_model = JOB_KINDS[job_data.kind][0]
+    try:
+        params = params_model.model_validate(job_data.params)
+    except ValidationError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=exc.errors(include_url=False, include_context=False)
+        )
+
+    job = Job(kind=job_data.kind, params=params.model_dump_json())
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+# Obtener un job por ID
+def get_job(job_id: int, session: Session) -> Job:
+    job = session.get(Job, job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job no encontrado"
+        )
+    return job
+
+
+# Encolar el job "archive" si no hay uno pendiente o en curso y el último se encoló hace
+# más de "interval" segundos. La fecha se lee de la tabla, así varios workers (o un
+# reinicio) no adelantan el archivado.
+def schedule_archive_job(session: Session, interval: float = JOB_ARCHIVE_INTERVAL_SECONDS) -> Optional[Job]:
+    pending = session.exec(
+        select(Job.id).where(Job.kind == "archive", Job.status.in_(["queued", "running"])).limit(1)
+    ).first()
+    if pending is not None:
+        return None
+    last = session.exec(select(func.max(Job.created_at)).where(Job.kind == "archive")).one()
+    if last is not None and last > datetime.now() - timedelta(seconds=interval):
+        return None
+    return enqueue_job(JobCreate(kind="archive"), session)
+
+
+# Reclamar el siguiente job pendiente. El UPDATE condicional garantiza que
+# dos workers no se quedan con el mismo job (funciona en MySQL y en SQLite).
+def claim_next_job(session: Session) -> Optional[int]:
+    while True:
+        job_id = session.exec(
+            select(Job.id).where(Job.status == "queued").order_by(Job.id).limit(1)
+        ).first()
+        if job_id is None:
+            return None
+
+        now = datetime.now()
+        claimed = session.exec(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "queued")
+            .values(status="running", started_at=now, heartbeat_at=now, attempts=Job.attempts + 1)
+        )
+        session.commit()
+        if claimed.rowcount == 1:
+            return job_id
+
+
+# Ejecutar un job ya reclamado con la sesión dada
+def run_job(job_id: int, session: Session) -> Job:
+    job = get_job(job_id, session)
+
+    def report(progress: float) -> None:
+        job.progress = min(1.0, progress)
+        session.add(job)
+        session.commit()
+
+    try:
+        params_model, handler = JOB_KINDS[job.kind]
+        result = handler(session, params_model.model_validate_json(job.params), report)
+    except Exception as exc:
+        logger.exception("Job %s falló", job_id)
+        session.rollback()
+        job.status = "failed"
+        job.error = str(exc) or exc.__class__.__name__
+    else:
+        job.status = "succeeded"
+        job.progress = 1.0
+        job.result = json.dumps(result, default=str)
+
+    job.finished_at = datetime.now()
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+# ============ WORKER ============
+
+# Cada proceso hijo abre sus propias conexiones a la BD
+def _init_worker_process() -> None:
+    engine.dispose(close=False)
+
+
+# Punto de entrada en el proceso hijo
+def execute_job(job_id: int) -> None:
+    with Session(engine) as session:
+        run_job(job_id, session)
+
+
+# Renovar el heartbeat de los jobs que ejecuta este worker
+def touch_jobs(session: Session, job_ids: List[int]) -> None:
+    if job_ids:
+        session.exec(
+            update(Job).where(Job.id.in_(job_ids), Job.status == "running").values(heartbeat_at=datetime.now())
+        )
+        session.commit()
+
+
+# Devolver a la cola (o marcar como fallidos si agotaron sus intentos) los jobs
+# "running" que cumplen la condición. Devuelve cuántos se recuperaron.
+def _release_jobs(session: Session, condition, error: str) -> int:
+    now = datetime.now()
+    failed = session.exec(
+        update(Job)
+        .where(Job.status == "running", condition, Job.attempts >= JOB_MAX_ATTEMPTS)
+        .values(status="failed", error=error, finished_at=now)
+    ).rowcount
+    requeued = session.exec(
+        update(Job)
+        .where(Job.status == "running", condition, Job.attempts < JOB_MAX_ATTEMPTS)
+        .values(status="queued", error=error, started_at=None, heartbeat_at=None, progress=0.0)
+    ).rowcount
+    session.commit()
+    return failed + requeued
+
+
+# Recuperar un job cuyo proceso terminó de forma inesperada
+def release_job(job_id: int, error: BaseException) -> None:
+    with Session(engine) as session:
+        _release_jobs(session, Job.id == job_id, f"El proceso del worker terminó: {error!r}")
+
+
+# Recuperar los jobs "running" sin heartbeat reciente (su worker murió o se redesplegó)
+def requeue_stale_jobs(session: Session, lease_seconds: float = JOB_LEASE_SECONDS) -> int:
+    cutoff = datetime.now() - timedelta(seconds=lease_seconds)
+    return _release_jobs(session, Job.heartbeat_at < cutoff, "El worker dejó de enviar heartbeat")
+
+
+# Cada job se ejecuta en su propio proceso (un pool de uno): si el proceso muere solo
+# se rompe ese pool, y el intento solo cuenta para ese job y no para los que corren a la vez
+def _start_job(job_id: int) -> Tuple[Future, ProcessPoolExecutor]:
+    pool = ProcessPoolExecutor(max_workers=1, initializer=_init_worker_process)
+    try:
+        return pool.submit(execute_job, job_id), pool
+    except BaseException:
+        pool.shutdown(wait=False)
+        raise
+
+
+# Bucle del worker: reclama jobs y ejecuta hasta "workers" a la vez, cada uno en su proceso.
+# También encola el archivado periódico de tareas completadas.
+def run_worker(
+    workers: int = JOB_WORKERS,
+    poll_seconds: float = JOB_POLL_SECONDS,
+    once: bool = False,
+    archive_interval: float = JOB_ARCHIVE_INTERVAL_SECONDS
+) -> None:
+    running: Dict[Future, Tuple[int, ProcessPoolExecutor]] = {}
+    last_heartbeat = 0.0
+    try:
+        while True:
+            for future in [future for future in running if future.done()]:
+                job_id, pool = running.pop(future)
+                pool.shutdown(wait=False)
+                error = future.exception()
+                if error is not None:
+                    release_job(job_id, error)
+
+            # Heartbeat de los jobs propios, recuperación de los huérfanos de otros workers
+            # y archivado periódico
+            if time.monotonic() - last_heartbeat >= JOB_HEARTBEAT_SECONDS:
+                with Session(engine) as session:
+                    touch_jobs(session, [job_id for job_id, _ in running.values()])
+                    requeue_stale_jobs(session)
+                    if archive_interval > 0:
+                        schedule_archive_job(session, archive_interval)
+                last_heartbeat = time.monotonic()
+
+            job_id = None
+            if len(running) < workers:
+                with Session(engine) as session:
+                    job_id = claim_next_job(session)
+                if job_id is not None:
+                    try:
+                        future, pool = _start_job(job_id)
+                    except Exception as error:
+                        release_job(job_id, error)
+                        raise
+                    running[future] = (job_id, pool)
+                    continue
+
+            # Con --once el worker termina cuando la cola queda vacía
+            if once and not running:
+                break
+            time.sleep(poll_seconds)
+    finally:
+        for _, pool in running.values():
+            pool.shutdown(wait=True)
+
+
+# Iniciar el worker: python -m src.jobs --workers 4
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de jobs")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--once", action="store_true", help="Terminar cuando no queden jobs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_worker(args.workers, once=args.once)
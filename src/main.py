@@ -2,7 +2,10 @@
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from .database import create_db_and_tables
-from .controllers import user_router, task_router
+from .archive import start_archive_worker, stop_archive_worker
+from .controllers import user_router, task_router, admin_router, job_router
+from .membership import user_filter, warm_user_filter
+from .profiling import ProfilingMiddleware, profiling_enabled
 
 
 # Función para inicializar la app (crear tablas)
@@ -10,8 +13,13 @@ from .controllers import user_router, task_router
 async def lifespan(app: FastAPI):
     # Al iniciar: crear las tablas en la BD
     create_db_and_tables()
+    # Llenar el filtro de usuarios para responder negativos sin consultar la BD
+    warm_user_filter()
+    # Iniciar el job que archiva las tareas completadas antiguas
+    archiver = start_archive_worker()
     yield
-    # Al cerrar: limpiar recursos si es necesario
+    # Al cerrar: detener el job de archivado
+    stop_archive_worker(archiver)
 
 
 # Crear la aplicación FastAPI
@@ -22,9 +30,15 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Perfilado por petición (solo si está configurado, sin coste cuando está apagado)
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
 # Incluir los routers
 app.include_router(user_router)
 app.include_router(task_router)
+app.include_router(admin_router)
+app.include_router(job_router)
 
 
 # Endpoint raíz
@@ -41,3 +55,9 @@ def root():
 @app.get("/health", tags=["Health"])
 def health():
     return {"status": "ok"}
+
+
+# Métricas del filtro de pertenencia de usuarios
+@app.get("/metrics/membership", tags=["Health"])
+def membership_metrics():
+    return user_filter.stats()
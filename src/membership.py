@@ -0,0 +1,143 @@
+# Filtro de pertenencia (Bloom) para IDs y emails de usuarios
+#
+# Responde "seguro que no existe" sin consultar la BD. Un "puede que exista" siempre
+# se confirma con la BD. El filtro se llena al arrancar desde la tabla users y se
+# actualiza en create_user, así que supone que los usuarios se crean desde este proceso
+# (como con run.py). Con varios workers, réplicas o inserciones manuales daría 404
+# incorrectos, por eso viene desactivado: MEMBERSHIP_FILTER_ENABLED=true para activarlo.
+# Hasta que no se ha llenado no responde negativos.
+from sqlmodel import Session, select
+from dotenv import load_dotenv
+from typing import Any, Dict
+import hashlib
+import math
+import os
+import threading
+from .database import engine
+from .models import User
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Configuración del filtro
+MEMBERSHIP_FILTER_ENABLED = os.getenv("MEMBERSHIP_FILTER_ENABLED", "false").lower() == "true"
+MEMBERSHIP_EXPECTED_USERS = int(os.getenv("MEMBERSHIP_EXPECTED_USERS", "100000"))
+MEMBERSHIP_FALSE_POSITIVE_RATE = float(os.getenv("MEMBERSHIP_FALSE_POSITIVE_RATE", "0.01"))
+
+
+# Filtro de Bloom sobre un bytearray (doble hashing con blake2b)
+class BloomFilter:
+    def __init__(self, expected_items: int, false_positive_rate: float):
+        expected_items = max(1, expected_items)
+        self.expected_items = expected_items
+        self.false_positive_rate = false_positive_rate
+        # Tamaño óptimo en bits y número de funciones hash
+        self.size = max(8, math.ceil(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / expected_items * math.log(2)))
+        self.items = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, value: str) -> None:
+        with self._lock:
+            for position in self._positions(value):
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.items += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    # Memoria usada por el array de bits
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    # Probabilidad de falso positivo estimada con los elementos actuales
+    @property
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.items / self.size)) ** self.hash_count
+
+
+# Filtro para los chequeos de existencia de usuario y unicidad de email
+class UserMembershipFilter:
+    def __init__(
+        self,
+        expected_users: int = MEMBERSHIP_EXPECTED_USERS,
+        false_positive_rate: float = MEMBERSHIP_FALSE_POSITIVE_RATE,
+        enabled: bool = MEMBERSHIP_FILTER_ENABLED
+    ):
+        self.expected_users = expected_users
+        self.false_positive_rate = false_positive_rate
+        self.enabled = enabled
+        self.ready = False
+        self.definite_negatives = 0
+        self.database_checks = 0
+        self._ids = BloomFilter(expected_users, false_positive_rate)
+        self._emails = BloomFilter(expected_users, false_positive_rate)
+
+    # Llenar el filtro con todos los usuarios de la BD
+    def warm(self, session: Session) -> None:
+        if not self.enabled:
+            return
+        self._ids = BloomFilter(self.expected_users, self.false_positive_rate)
+        self._emails = BloomFilter(self.expected_users, self.false_positive_rate)
+        rows = session.exec(select(User.id, User.email).execution_options(yield_per=1000))
+        for user_id, email in rows:
+            self._ids.add(str(user_id))
+            self._emails.add(email)
+        self.ready = True
+
+    # Registrar un usuario recién creado
+    def add_user(self, user: User) -> None:
+        if self.ready:
+            self._ids.add(str(user.id))
+            self._emails.add(user.email)
+
+    def _check(self, bloom: BloomFilter, value: str) -> bool:
+        if not self.ready:
+            return True
+        if value in bloom:
+            self.database_checks += 1
+            return True
+        self.definite_negatives += 1
+        return False
+
+    # False solo si el usuario seguro que no existe
+    def might_have_user_id(self, user_id: int) -> bool:
+        return self._check(self._ids, str(user_id))
+
+    # False solo si el email seguro que no está registrado
+    def might_have_email(self, email: str) -> bool:
+        return self._check(self._emails, email)
+
+    # Métricas del filtro
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "users": self._ids.items,
+            "expected_users": self.expected_users,
+            "hash_count": self._ids.hash_count,
+            "size_bytes": self._ids.size_bytes + self._emails.size_bytes,
+            "configured_false_positive_rate": self.false_positive_rate,
+            "estimated_false_positive_rate": self._ids.estimated_false_positive_rate,
+            "definite_negatives": self.definite_negatives,
+            "database_checks": self.database_checks
+        }
+
+
+# Instancia compartida por toda la aplicación
+user_filter = UserMembershipFilter()
+
+
+# Llenar el filtro compartido desde la BD (al arrancar la app)
+def warm_user_filter() -> None:
+    with Session(engine) as session:
+        user_filter.warm(session)
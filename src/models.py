@@ -1,6 +1,7 @@
 # Modelos de la base de datos
 from sqlmodel import SQLModel, Field, Relationship
-from typing import Optional, List
+from sqlalchemy import Column, Index, Text
+from typing import Any, Dict, Optional, List
 from datetime import datetime
 
 
@@ -19,6 +20,12 @@ class User(SQLModel, table=True):
 # Modelo de Tarea
 class Task(SQLModel, table=True):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # Índice para que el archivado encuentre rápido las tareas completadas antiguas
+        Index("ix_tasks_completed_created", "is_completed", "created_at"),
+        # En SQLite evita reutilizar IDs de tareas ya movidas al archivo
+        {"sqlite_autoincrement": True},
+    )
     
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str = Field(min_length=1, max_length=200)
@@ -31,6 +38,41 @@ class Task(SQLModel, table=True):
     user: Optional[User] = Relationship(back_populates="tasks")
 
 
+# Modelo de Tarea archivada (tareas completadas antiguas fuera de la tabla principal)
+class TaskArchive(SQLModel, table=True):
+    __tablename__ = "tasks_archive"
+    
+    # Conserva el mismo ID que tenía en la tabla tasks
+    id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    title: str = Field(max_length=200)
+    description: Optional[str] = Field(default=None, max_length=1000)
+    is_completed: bool = Field(default=True)
+    user_id: int = Field(foreign_key="users.id", index=True)
+    created_at: datetime
+    archived_at: datetime = Field(default_factory=datetime.now)
+
+
+# Modelo de Job (trabajo pesado que se ejecuta fuera del request en el worker)
+class Job(SQLModel, table=True):
+    __tablename__ = "jobs"
+    
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str = Field(max_length=50)
+    # Parámetros y resultado guardados como JSON
+    params: str = Field(default="{}", sa_column=Column(Text, nullable=False))
+    status: str = Field(default="queued", max_length=20, index=True)
+    progress: float = Field(default=0.0)
+    # Veces que un worker ha reclamado el job
+    attempts: int = Field(default=0)
+    result: Optional[str] = Field(default=None, sa_column=Column(Text))
+    error: Optional[str] = Field(default=None, sa_column=Column(Text))
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: Optional[datetime] = None
+    # Última señal de vida del worker que lo ejecuta (para recuperar jobs huérfanos)
+    heartbeat_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
 # Schemas para crear y leer datos
 
 # Para crear un usuario nuevo
@@ -73,3 +115,24 @@ class TaskRead(SQLModel):
 # Para mostrar un usuario con sus tareas
 class UserWithTasks(UserRead):
     tasks: List[TaskRead] = []
+
+
+# Para encolar un job
+class JobCreate(SQLModel):
+    kind: str
+    params: Dict[str, Any] = {}
+
+
+# Para mostrar el estado de un job
+class JobRead(SQLModel):
+    id: int
+    kind: str
+    params: Dict[str, Any]
+    status: str
+    progress: float
+    attempts: int
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
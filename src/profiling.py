@@ -0,0 +1,239 @@
+# Perfilado opcional por petición (muestreo estadístico con salida "collapsed stacks")
+#
+# Se activa con la cabecera X-Profile igual a PROFILE_ADMIN_TOKEN, o al azar según
+# PROFILE_SAMPLE_RATE. Si ninguna de las dos está configurada el middleware no se instala.
+# Los ficheros .folded se abren directamente en speedscope o con flamegraph.pl.
+#
+# Solo se muestrean los hilos que están trabajando para la petición perfilada: el
+# middleware guarda el muestreador en una contextvar (que se propaga a los hilos del
+# threadpool) y ProfiledRoute registra el event loop, el endpoint y la validación de la
+# respuesta. Así no se mezclan hilos en segundo plano como el archivador.
+from collections import Counter
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Callable, Coroutine, Dict, Optional
+import fastapi.routing as fastapi_routing
+import functools
+import hmac
+import inspect
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Configuración del perfilado
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+PROFILE_HEADER = b"x-profile"
+
+logger = logging.getLogger(__name__)
+
+# Ficheros donde está un hilo inactivo (esperando trabajo o eventos)
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+
+
+# Indica si el perfilado está configurado de alguna forma
+def profiling_enabled() -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+# Muestreador: cada intervalo guarda la pila de los hilos registrados para la petición
+class Sampler:
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # hilo -> número de llamadas registradas en curso
+        self._threads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def add_thread(self, thread_id: int) -> None:
+        with self._lock:
+            self._threads[thread_id] = self._threads.get(thread_id, 0) + 1
+
+    def remove_thread(self, thread_id: int) -> None:
+        with self._lock:
+            if self._threads.get(thread_id, 0) <= 1:
+                self._threads.pop(thread_id, None)
+            else:
+                self._threads[thread_id] -= 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        names = {}
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                thread_ids = list(self._threads)
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None or _is_idle(frame):
+                    continue
+                if thread_id not in names:
+                    names[thread_id] = _thread_name(thread_id)
+                self.stacks[_collapse(names[thread_id], frame)] += 1
+
+    # Escribir las pilas en formato "collapsed" (una línea "a;b;c N" por pila)
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as output:
+            for stack, count in self.stacks.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+def _is_idle(frame) -> bool:
+    return os.path.basename(frame.f_code.co_filename) in _IDLE_FILES
+
+
+def _thread_name(thread_id: int) -> str:
+    for thread in threading.enumerate():
+        if thread.ident == thread_id:
+            return thread.name
+    return str(thread_id)
+
+
+def _collapse(thread_name: str, frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+# Muestreador de la petición en curso (None si no se está perfilando)
+_active_sampler: ContextVar[Optional[Sampler]] = ContextVar("active_sampler", default=None)
+
+
+# Registrar el hilo actual en el muestreador mientras se ejecuta la función
+def profiled(func: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sampler = _active_sampler.get()
+        if sampler is None:
+            return func(*args, **kwargs)
+        thread_id = threading.get_ident()
+        sampler.add_thread(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.remove_thread(thread_id)
+    wrapper._profiled = True
+    return wrapper
+
+
+# Ruta que registra en el muestreador todos los hilos que trabajan para la petición:
+# el del event loop mientras dura el manejador (validación del cuerpo y serialización),
+# el del threadpool que ejecuta el endpoint (servicios, ORM y BD) y el que valida el
+# response_model (p. ej. TaskRead). Sin perfilado activo el coste es leer una contextvar.
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    # Ruta con la que FastAPI construye el manejador: las versiones recientes crean una
+    # copia por cada include_router (con su propio response_field) y la exponen en una
+    # contextvar mientras llaman a get_route_handler
+    def _handler_route(self) -> Any:
+        context_var = getattr(fastapi_routing, "_effective_route_context_var", None)
+        context = context_var.get() if context_var is not None else None
+        if context is not None and getattr(context, "original_route", None) is self:
+            return context
+        return self
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        # FastAPI valida la respuesta de los endpoints síncronos en otra llamada al threadpool
+        field = getattr(self._handler_route(), "response_field", None)
+        if field is not None and not getattr(field.validate, "_profiled", False):
+            field.validate = profiled(field.validate)
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request: Request) -> Response:
+            sampler = _active_sampler.get()
+            if sampler is None:
+                return await handler(request)
+            # Mientras espera al threadpool el event loop está en selectors.py y no cuenta
+            thread_id = threading.get_ident()
+            sampler.add_thread(thread_id)
+            try:
+                return await handler(request)
+            finally:
+                sampler.remove_thread(thread_id)
+
+        return profiled_handler
+
+
+# Nombre de fichero seguro a partir del método y la ruta
+def profile_path(method: str, route: str) -> str:
+    tag = re.sub(r"[^A-Za-z0-9.-]+", "_", route).strip("_") or "root"
+    return os.path.join(PROFILE_DIR, f"{method}_{tag}_{time.time_ns()}.folded")
+
+
+# Middleware ASGI: decide si perfilar la petición y guarda el resultado
+class ProfilingMiddleware:
+    # Solo se permite un perfilado a la vez para no mezclar peticiones
+    _busy = threading.Lock()
+
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> bool:
+        if PROFILE_ADMIN_TOKEN:
+            for name, value in scope.get("headers", []):
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value.decode("latin-1"), PROFILE_ADMIN_TOKEN)
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE  # nosec B311
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        if not self._busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        sampler = Sampler()
+        token = _active_sampler.set(sampler)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _active_sampler.reset(token)
+            self._busy.release()
+            # Parar el muestreador y escribir el fichero fuera del event loop
+            await run_in_threadpool(self._save, sampler, scope)
+
+    def _save(self, sampler: Sampler, scope) -> None:
+        sampler.stop()
+        route = scope.get("route")
+        path = profile_path(scope["method"], getattr(route, "path", scope["path"]))
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            sampler.write(path)
+            logger.info("Perfil guardado en %s", path)
+        except OSError:
+            logger.exception("No se pudo guardar el perfil")
@@ -1,33 +1,46 @@
 # Servicios - Lógica de negocio
 from sqlmodel import Session, select
 from fastapi import HTTPException, status
-from .models import User, Task, UserCreate, TaskCreate, TaskUpdate
-from typing import List
+from sqlalchemy.exc import IntegrityError
+from .models import User, Task, TaskArchive, UserCreate, TaskCreate, TaskUpdate
+from .membership import user_filter
+from typing import List, Optional, Union
 
 
 # ============ SERVICIOS DE USUARIOS ============
 
 # Crear un usuario nuevo
 def create_user(user_data: UserCreate, session: Session) -> User:
-    # Verificar si el email ya existe
-    existing_user = session.exec(select(User).where(User.email == user_data.email)).first()
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El email ya está registrado"
-        )
+    # Verificar si el email ya existe (el filtro evita la consulta si seguro que no existe)
+    if user_filter.might_have_email(user_data.email):
+        existing_user = session.exec(select(User).where(User.email == user_data.email)).first()
+        if existing_user:
+            raise_email_taken()
     
-    # Crear el usuario
+    # Crear el usuario (la restricción UNIQUE de la BD cubre las carreras)
     user = User.model_validate(user_data)
     session.add(user)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise_email_taken()
     session.refresh(user)
+    user_filter.add_user(user)
     return user
 
 
+# Error de email duplicado
+def raise_email_taken() -> None:
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="El email ya está registrado"
+    )
+
+
 # Obtener un usuario por ID
 def get_user(user_id: int, session: Session) -> User:
-    user = session.get(User, user_id)
+    user = user_filter.might_have_user_id(user_id) and session.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -46,8 +59,8 @@ def list_users(session: Session, skip: int = 0, limit: int = 100) -> List[User]:
 
 # Crear una tarea para un usuario
 def create_task(task_data: TaskCreate, session: Session) -> Task:
-    # Verificar que el usuario existe
-    user = session.get(User, task_data.user_id)
+    # Verificar que el usuario existe (sin consultar la BD si seguro que no existe)
+    user = user_filter.might_have_user_id(task_data.user_id) and session.get(User, task_data.user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -62,10 +75,12 @@ def create_task(task_data: TaskCreate, session: Session) -> Task:
     return task
 
 
-# Listar tareas de un usuario específico
-def list_user_tasks(user_id: int, session: Session) -> List[Task]:
-    # Verificar que el usuario existe
-    user = session.get(User, user_id)
+# Listar tareas de un usuario específico (opcionalmente incluyendo las archivadas)
+def list_user_tasks(
+    user_id: int, session: Session, include_archived: bool = False
+) -> List[Union[Task, TaskArchive]]:
+    # Verificar que el usuario existe (sin consultar la BD si seguro que no existe)
+    user = user_filter.might_have_user_id(user_id) and session.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -74,12 +89,16 @@ def list_user_tasks(user_id: int, session: Session) -> List[Task]:
     
     # Obtener todas las tareas del usuario
     tasks = session.exec(select(Task).where(Task.user_id == user_id)).all()
-    return tasks
+    if not include_archived:
+        return tasks
+    
+    archived = session.exec(select(TaskArchive).where(TaskArchive.user_id == user_id)).all()
+    return sorted([*tasks, *archived], key=lambda task: task.id)
 
 
-# Obtener una tarea por ID
-def get_task(task_id: int, session: Session) -> Task:
-    task = session.get(Task, task_id)
+# Obtener una tarea por ID (si no está en la tabla principal se busca en el archivo)
+def get_task(task_id: int, session: Session) -> Union[Task, TaskArchive]:
+    task = session.get(Task, task_id) or session.get(TaskArchive, task_id)
     if not task:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -88,9 +107,28 @@ def get_task(task_id: int, session: Session) -> Task:
     return task
 
 
+# Devolver una tarea archivada a la tabla principal (para poder modificarla)
+def restore_archived_task(task_id: int, session: Session) -> Optional[Task]:
+    archived = session.get(TaskArchive, task_id)
+    if not archived:
+        return None
+    
+    task = Task(
+        id=archived.id,
+        title=archived.title,
+        description=archived.description,
+        is_completed=archived.is_completed,
+        user_id=archived.user_id,
+        created_at=archived.created_at
+    )
+    session.delete(archived)
+    session.add(task)
+    return task
+
+
 # Actualizar una tarea (título, descripción o estado)
 def update_task(task_id: int, task_data: TaskUpdate, session: Session) -> Task:
-    task = session.get(Task, task_id)
+    task = session.get(Task, task_id) or restore_archived_task(task_id, session)
     if not task:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -108,9 +146,9 @@ def update_task(task_id: int, task_data: TaskUpdate, session: Session) -> Task:
     return task
 
 
-# Eliminar una tarea
+# Eliminar una tarea (también si está archivada)
 def delete_task(task_id: int, session: Session) -> None:
-    task = session.get(Task, task_id)
+    task = session.get(Task, task_id) or session.get(TaskArchive, task_id)
     if not task:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -0,0 +1,251 @@
+# Exportación de snapshots columnares (Parquet / Arrow IPC) para analítica
+#
+# Las filas se leen con un cursor del lado del servidor y se escriben por lotes
+# (record batches), así la memoria usada no depende del tamaño de la tabla.
+# Los snapshots incrementales guardan una marca (fecha, id) por tabla y la siguiente
+# ejecución solo exporta lo posterior. La fecha es la de llegada de la fila a la tabla:
+# created_at en tasks y archived_at en tasks_archive (se archiva en cualquier orden).
+# users no tiene fecha: su id se asigna antes del commit y un usuario confirmado tarde
+# quedaría detrás de la marca, así que siempre se exporta completa.
+from sqlmodel import Session, select
+from sqlalchemy import and_, or_
+from dotenv import load_dotenv
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+import argparse
+import json
+import os
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from .database import engine
+from .models import User, Task, TaskArchive
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+# Cargar variables del archivo .env
+load_dotenv()
+
+# Configuración de los snapshots
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", "10000"))
+# Las fechas se asignan en la app antes del commit: una transacción lenta puede confirmar
+# una fila con fecha anterior a la marca. Los incrementales solo exportan filas más
+# antiguas que este margen, para que esas filas no queden detrás de la marca.
+SNAPSHOT_SAFETY_LAG_SECONDS = float(os.getenv("SNAPSHOT_SAFETY_LAG_SECONDS", "60"))
+
+SNAPSHOT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Tablas exportables: modelo, esquema Arrow y columna de fecha de la marca incremental
+# (None = sin incremental, siempre completa)
+SNAPSHOT_TABLES: Dict[str, Dict[str, Any]] = {
+    "users": {
+        "model": User,
+        "schema": pa.schema([
+            ("id", pa.int64()),
+            ("name", pa.string()),
+            ("email", pa.string()),
+        ]),
+        "watermark_column": None,
+    },
+    "tasks": {
+        "model": Task,
+        "schema": pa.schema([
+            ("id", pa.int64()),
+            ("title", pa.string()),
+            ("description", pa.string()),
+            ("is_completed", pa.bool_()),
+            ("user_id", pa.int64()),
+            ("created_at", pa.timestamp("us")),
+        ]),
+        "watermark_column": "created_at",
+    },
+    "tasks_archive": {
+        "model": TaskArchive,
+        "schema": pa.schema([
+            ("id", pa.int64()),
+            ("title", pa.string()),
+            ("description", pa.string()),
+            ("is_completed", pa.bool_()),
+            ("user_id", pa.int64()),
+            ("created_at", pa.timestamp("us")),
+            ("archived_at", pa.timestamp("us")),
+        ]),
+        "watermark_column": "archived_at",
+    },
+}
+
+
+# Leer la marca del último snapshot incremental de una tabla
+def read_watermark(table: str, directory: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    path = os.path.join(directory or SNAPSHOT_DIR, f"{table}.watermark.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as state:
+        return json.load(state)
+
+
+def _write_watermark(table: str, watermark: Dict[str, Any], directory: str) -> None:
+    path = os.path.join(directory, f"{table}.watermark.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as state:
+        json.dump(watermark, state)
+    os.replace(path + ".tmp", path)
+
+
+# Construir la consulta ordenada por la clave incremental (fecha, id), o por id
+def _snapshot_query(
+    config: Dict[str, Any], watermark: Optional[Dict[str, Any]], until: Optional[datetime] = None
+):
+    model = config["model"]
+    columns = [getattr(model, field.name) for field in config["schema"]]
+    query = select(*columns)
+
+    column_name = config["watermark_column"]
+    if column_name is None:
+        return query.order_by(model.id)
+
+    column = getattr(model, column_name)
+    query = query.order_by(column, model.id)
+    if until is not None:
+        query = query.where(column < until)
+    # Una marca sin esta columna (de una versión anterior) se ignora: exportación completa
+    if watermark and column_name in watermark:
+        last_value = datetime.fromisoformat(watermark[column_name])
+        query = query.where(or_(
+            column > last_value,
+            and_(column == last_value, model.id > watermark["id"])
+        ))
+    return query
+
+
+# Bloquear la marca de una tabla entre procesos (p. ej. dos jobs en el pool del worker)
+@contextmanager
+def _watermark_lock(table: str, directory: str) -> Iterator[None]:
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, f"{table}.watermark.json.lock"), "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+# Exportar una tabla a un fichero Parquet o Arrow IPC
+def export_table(
+    session: Session,
+    table: str,
+    fmt: str = "parquet",
+    incremental: bool = False,
+    directory: Optional[str] = None,
+    batch_size: int = SNAPSHOT_BATCH_SIZE,
+    safety_lag: Optional[float] = None
+) -> Dict[str, Any]:
+    if table not in SNAPSHOT_TABLES:
+        raise ValueError(f"Tabla desconocida: {table}")
+    if fmt not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Formato desconocido: {fmt}")
+
+    directory = directory or SNAPSHOT_DIR
+    os.makedirs(directory, exist_ok=True)
+    if not incremental or SNAPSHOT_TABLES[table]["watermark_column"] is None:
+        return _export(session, table, fmt, directory, batch_size)
+
+    # Leer la marca, exportar y escribir la nueva marca con la tabla bloqueada: dos
+    # incrementales a la vez partirían de la misma marca y exportarían las mismas filas
+    lag = SNAPSHOT_SAFETY_LAG_SECONDS if safety_lag is None else safety_lag
+    with _watermark_lock(table, directory):
+        watermark = read_watermark(table, directory)
+        until = datetime.now() - timedelta(seconds=lag)
+        return _export(session, table, fmt, directory, batch_size, watermark, until, incremental=True)
+
+
+def _export(
+    session: Session,
+    table: str,
+    fmt: str,
+    directory: str,
+    batch_size: int,
+    watermark: Optional[Dict[str, Any]] = None,
+    until: Optional[datetime] = None,
+    incremental: bool = False
+) -> Dict[str, Any]:
+    config = SNAPSHOT_TABLES[table]
+    schema = config["schema"]
+    suffix = "_incremental" if incremental else ""
+    path = os.path.join(
+        directory, f"{table}_{datetime.now().strftime('%Y%m%dT%H%M%S%f')}{suffix}{SNAPSHOT_FORMATS[fmt]}"
+    )
+
+    # Cursor del lado del servidor: las filas llegan en bloques de batch_size
+    result = session.connection().execution_options(
+        stream_results=True, yield_per=batch_size
+    ).execute(_snapshot_query(config, watermark, until))
+
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = ipc.new_file(path, schema)
+
+    rows = 0
+    last_row = None
+    try:
+        for partition in result.partitions(batch_size):
+            columns = list(zip(*partition))
+            batch = pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                schema=schema
+            )
+            writer.write_batch(batch)
+            rows += len(partition)
+            last_row = partition[-1]._mapping
+    except BaseException:
+        # No dejar ficheros a medias
+        writer.close()
+        os.remove(path)
+        raise
+    else:
+        writer.close()
+    finally:
+        result.close()
+
+    # La marca solo avanza cuando el fichero se ha escrito completo
+    if incremental and last_row is not None:
+        column_name = config["watermark_column"]
+        new_watermark = {"id": last_row["id"], column_name: last_row[column_name].isoformat()}
+        _write_watermark(table, new_watermark, directory)
+
+    return {"table": table, "format": fmt, "incremental": incremental, "rows": rows, "path": path}
+
+
+# Exportar varias tablas (por defecto todas)
+def export_snapshot(
+    session: Session,
+    fmt: str = "parquet",
+    incremental: bool = False,
+    tables: Optional[List[str]] = None,
+    directory: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    return [
+        export_table(session, table, fmt, incremental, directory)
+        for table in (tables or list(SNAPSHOT_TABLES))
+    ]
+
+
+# Ejecutar desde la línea de comandos: python -m src.snapshot --format parquet --incremental
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exportar snapshots de users y tasks")
+    parser.add_argument("--format", choices=list(SNAPSHOT_FORMATS), default="parquet")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--tables", nargs="*", choices=list(SNAPSHOT_TABLES))
+    parser.add_argument("--directory", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        for item in export_snapshot(session, args.format, args.incremental, args.tables, args.directory):
+            print(f"{item['table']}: {item['rows']} filas -> {item['path']}")
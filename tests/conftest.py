@@ -5,6 +5,7 @@ from sqlmodel.pool import StaticPool
 from fastapi.testclient import TestClient
 from src.main import app
 from src.database import get_session
+from src.idempotency import idempotency_store
 
 
 # Fixture para crear una sesión de BD en memoria (para tests)
@@ -32,3 +33,4 @@ def client_fixture(session: Session):
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
+    idempotency_store.clear()
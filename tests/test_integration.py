@@ -1,5 +1,10 @@
 # Pruebas de Integración - Endpoints
 from fastapi.testclient import TestClient
+import threading
+import time
+from src import controllers, jobs, main, profiling, services, snapshot
+from src.database import get_session
+from src.membership import UserMembershipFilter
 
 
 # ============ PRUEBAS DE ENDPOINTS RAÍZ ============
@@ -17,6 +22,39 @@ def test_health_endpoint(client: TestClient):
     assert response.json()["status"] == "ok"
 
 
+def test_membership_metrics_endpoint(client: TestClient):
+    response = client.get("/metrics/membership")
+    assert response.status_code == 200
+    # Por defecto el filtro está desactivado y no responde negativos
+    assert response.json()["enabled"] is False
+    assert response.json()["ready"] is False
+
+
+def test_membership_filter_warmed_through_api(client: TestClient, session, monkeypatch):
+    user = client.post("/users/", json={"name": "Filtro", "email": "api-filtro@test.com"}).json()
+    
+    # Simular el arranque con el filtro activado
+    user_filter = UserMembershipFilter(expected_users=100, enabled=True)
+    user_filter.warm(session)
+    monkeypatch.setattr(services, "user_filter", user_filter)
+    monkeypatch.setattr(main, "user_filter", user_filter)
+    
+    # Usuario inexistente: 404 sin consultar la BD
+    assert client.post("/tasks/", json={"title": "Tarea", "user_id": 999}).status_code == 404
+    assert client.get("/users/999").status_code == 404
+    
+    # Los usuarios existentes y los nuevos siguen funcionando
+    assert client.post("/tasks/", json={"title": "Tarea", "user_id": user["id"]}).status_code == 201
+    new_user = client.post("/users/", json={"name": "Nuevo", "email": "api-nuevo@test.com"}).json()
+    assert client.get(f"/users/{new_user['id']}").status_code == 200
+    assert client.post("/users/", json={"name": "Nuevo", "email": "api-nuevo@test.com"}).status_code == 400
+    
+    metrics = client.get("/metrics/membership").json()
+    assert metrics["ready"] is True
+    assert metrics["users"] == 2
+    assert metrics["definite_negatives"] >= 2
+
+
 # ============ PRUEBAS DE INTEGRACIÓN DE USUARIOS ============
 
 def test_create_and_get_user(client: TestClient):
@@ -135,3 +173,187 @@ def test_get_user_tasks(client: TestClient):
     assert response.status_code == 200
     tasks = response.json()
     assert len(tasks) == 3
+
+
+# ============ PRUEBAS DE IDEMPOTENCIA ============
+
+def test_create_task_idempotency_key_replays_response(client: TestClient):
+    user = client.post("/users/", json={"name": "Retry", "email": "retry@test.com"}).json()
+    task_data = {"title": "Una sola vez", "user_id": user["id"]}
+    headers = {"Idempotency-Key": "task-retry-1"}
+    
+    # El reintento devuelve la misma tarea sin crear un duplicado
+    first = client.post("/tasks/", json=task_data, headers=headers)
+    second = client.post("/tasks/", json=task_data, headers=headers)
+    
+    assert first.status_code == 201
+    assert second.status_code == 201
+    assert second.json() == first.json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert len(client.get(f"/users/{user['id']}/tasks").json()) == 1
+
+
+def test_create_user_idempotency_key_replays_response(client: TestClient):
+    user_data = {"name": "Retry", "email": "retry-user@test.com"}
+    headers = {"Idempotency-Key": "user-retry-1"}
+    
+    # El reintento no devuelve 400 por email duplicado
+    first = client.post("/users/", json=user_data, headers=headers)
+    second = client.post("/users/", json=user_data, headers=headers)
+    
+    assert second.status_code == 201
+    assert second.json()["id"] == first.json()["id"]
+
+
+def test_idempotency_key_reused_with_different_body(client: TestClient):
+    headers = {"Idempotency-Key": "user-retry-2"}
+    client.post("/users/", json={"name": "Uno", "email": "uno@test.com"}, headers=headers)
+    
+    # Reutilizar la clave con otro cuerpo es un conflicto
+    response = client.post("/users/", json={"name": "Dos", "email": "dos@test.com"}, headers=headers)
+    assert response.status_code == 409
+
+
+def test_idempotency_key_too_long(client: TestClient):
+    headers = {"Idempotency-Key": "x" * 256}
+    response = client.post("/users/", json={"name": "Largo", "email": "largo@test.com"}, headers=headers)
+    
+    # La clave se rechaza antes de crear nada
+    assert response.status_code == 400
+    assert client.get("/users/").json() == []
+
+
+# ============ PRUEBAS DE PERFILADO ============
+
+def test_profiling_header_writes_collapsed_stacks(client: TestClient, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_ADMIN_TOKEN", "secreto")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    profiled_client = TestClient(profiling.ProfilingMiddleware(client.app))
+    
+    # Sin la cabecera (o con un token incorrecto) no se perfila
+    profiled_client.get("/users/")
+    profiled_client.get("/users/", headers={"X-Profile": "otro"})
+    assert list(tmp_path.iterdir()) == []
+    
+    # Con el token correcto se guarda un fichero etiquetado con la ruta
+    response = profiled_client.get("/users/", headers={"X-Profile": "secreto"})
+    assert response.status_code == 200
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1
+    assert files[0].name.startswith("GET_users_")
+    assert files[0].suffix == ".folded"
+
+
+def test_profiling_samples_only_request_threads(client: TestClient, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_ADMIN_TOKEN", "secreto")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    profiled_client = TestClient(profiling.ProfilingMiddleware(client.app))
+    
+    def slow_list_users(session, skip, limit):
+        time.sleep(0.05)
+        return []
+    
+    monkeypatch.setattr(services, "list_users", slow_list_users)
+    
+    # Un hilo ocupado ajeno a la petición no debe aparecer en el perfil
+    stop = threading.Event()
+    
+    def noise_loop():
+        while not stop.is_set():
+            sum(range(1000))
+    
+    noise = threading.Thread(target=noise_loop, name="ruido")
+    noise.start()
+    try:
+        response = profiled_client.get("/users/", headers={"X-Profile": "secreto"})
+    finally:
+        stop.set()
+        noise.join()
+    
+    assert response.status_code == 200
+    content = next(tmp_path.iterdir()).read_text()
+    assert "slow_list_users" in content
+    assert "noise_loop" not in content
+
+
+def test_profiling_samples_event_loop_and_response_validation(client: TestClient, session, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_ADMIN_TOKEN", "secreto")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    profiled_client = TestClient(profiling.ProfilingMiddleware(client.app))
+    
+    # Leer un atributo durante la validación de UserRead es lento
+    class SlowUser:
+        id = 1
+        email = "lento@test.com"
+        
+        @property
+        def name(self):
+            time.sleep(0.05)
+            return "Lento"
+    
+    monkeypatch.setattr(services, "list_users", lambda session, skip, limit: [SlowUser()])
+    
+    # Una dependencia async se resuelve en el hilo del event loop
+    async def busy_session_override():
+        deadline = time.monotonic() + 0.05
+        while time.monotonic() < deadline:
+            pass
+        return session
+    
+    client.app.dependency_overrides[get_session] = busy_session_override
+    response = profiled_client.get("/users/", headers={"X-Profile": "secreto"})
+    
+    assert response.status_code == 200
+    assert response.json()[0]["name"] == "Lento"
+    content = next(tmp_path.iterdir()).read_text()
+    assert "busy_session_override" in content
+    # La validación del response_model se hace en otro hilo del threadpool
+    assert any(
+        ";validate (" in line and ";name (test_integration.py" in line for line in content.splitlines()
+    )
+
+
+# ============ PRUEBAS DE ADMINISTRACIÓN ============
+
+def test_snapshot_endpoint_requires_admin_token(client: TestClient, session, tmp_path, monkeypatch):
+    monkeypatch.setattr(controllers, "ADMIN_TOKEN", "admin")
+    monkeypatch.setattr(snapshot, "SNAPSHOT_DIR", str(tmp_path))
+    headers = {"X-Admin-Token": "admin"}
+    client.post("/users/", json={"name": "Snap", "email": "snap@test.com"})
+    
+    assert client.post("/admin/snapshots").status_code == 403
+    assert client.post("/admin/snapshots", params={"tables": "nada"}, headers=headers).status_code == 400
+    
+    # La exportación se encola como job y no se ejecuta en el request
+    response = client.post("/admin/snapshots", params={"tables": "users"}, headers=headers)
+    assert response.status_code == 202
+    job = response.json()
+    assert job["kind"] == "snapshot"
+    assert job["status"] == "queued"
+    assert list(tmp_path.iterdir()) == []
+    
+    # Simular el worker
+    jobs.run_job(jobs.claim_next_job(session), session)
+    result = client.get(f"/jobs/{job['id']}", headers=headers).json()["result"]
+    assert result["files"][0]["rows"] == 1
+    assert (tmp_path / result["files"][0]["path"].split("/")[-1]).exists()
+
+
+def test_create_and_get_job(client: TestClient, session, monkeypatch):
+    monkeypatch.setattr(controllers, "ADMIN_TOKEN", "admin")
+    headers = {"X-Admin-Token": "admin"}
+    
+    # Encolar un job devuelve 202 y queda pendiente
+    response = client.post("/jobs/", json={"kind": "archive"}, headers=headers)
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] == "queued"
+    
+    # Simular el worker y consultar el resultado
+    jobs.run_job(jobs.claim_next_job(session), session)
+    response = client.get(f"/jobs/{job['id']}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["status"] == "succeeded"
+    assert response.json()["result"] == {"archived": 0}
+    
+    assert client.get("/jobs/999", headers=headers).status_code == 404
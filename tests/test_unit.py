@@ -1,9 +1,24 @@
 # Pruebas Unitarias - Servicios
 import pytest
-from sqlmodel import Session
+from datetime import datetime, timedelta
+import functools
+import multiprocessing
+import os
+import threading
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlmodel import Session, SQLModel, create_engine, func, select
 from fastapi import HTTPException
-from src.models import UserCreate, TaskCreate, TaskUpdate
-from src import services
+from src.models import Job, Task, TaskArchive, UserCreate, TaskCreate, TaskUpdate, JobCreate
+from src import services, jobs
+from src import idempotency
+from src.idempotency import IdempotencyStore
+from src.archive import (
+    archive_completed_tasks, move_tasks, select_archivable_ids, start_archive_worker, stop_archive_worker
+)
+from src.membership import BloomFilter, UserMembershipFilter
+from src.snapshot import export_table, read_watermark
 
 
 # ============ PRUEBAS DE SERVICIOS DE USUARIOS ============
@@ -147,3 +162,526 @@ def test_delete_task_not_found(session: Session):
         services.delete_task(999, session)
     
     assert exc_info.value.status_code == 404
+
+
+# ============ PRUEBAS DEL ALMACÉN DE IDEMPOTENCIA ============
+
+def test_idempotency_store_runs_operation_once():
+    store = IdempotencyStore()
+    calls = []
+    
+    def operation():
+        calls.append(1)
+        return "resultado"
+    
+    assert store.run("scope", "k", "hash", operation) == ("resultado", False)
+    assert store.run("scope", "k", "hash", operation) == ("resultado", True)
+    assert len(calls) == 1
+
+
+def test_idempotency_store_does_not_save_failures():
+    store = IdempotencyStore()
+    
+    def failing():
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    
+    with pytest.raises(HTTPException):
+        store.run("scope", "k", "hash", failing)
+    
+    # Después del fallo la clave queda libre para reintentar
+    assert store.run("scope", "k", "hash", lambda: "ok") == ("ok", False)
+
+
+def test_idempotency_store_concurrent_duplicate_waits_for_first():
+    store = IdempotencyStore()
+    release = threading.Event()
+    started = threading.Event()
+    calls = []
+    results = {}
+    
+    def slow_operation():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "resultado"
+    
+    first = threading.Thread(target=lambda: results.update(first=store.run("scope", "k", "hash", slow_operation)))
+    first.start()
+    started.wait(5)
+    
+    second = threading.Thread(target=lambda: results.update(second=store.run("scope", "k", "hash", slow_operation)))
+    second.start()
+    
+    # Con la primera en curso, un cuerpo distinto con la misma clave es un conflicto
+    with pytest.raises(HTTPException) as exc_info:
+        store.run("scope", "k", "otro-hash", slow_operation)
+    assert exc_info.value.status_code == 409
+    
+    # La segunda espera a la primera y recibe la respuesta repetida
+    second.join(0.05)
+    assert second.is_alive()
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert results == {"first": ("resultado", False), "second": ("resultado", True)}
+    assert len(calls) == 1
+
+
+def test_idempotency_store_wait_timeout(monkeypatch):
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_WAIT_SECONDS", 0.05)
+    store = IdempotencyStore()
+    release = threading.Event()
+    started = threading.Event()
+    
+    def slow_operation():
+        started.set()
+        release.wait(5)
+        return "resultado"
+    
+    first = threading.Thread(target=lambda: store.run("scope", "k", "hash", slow_operation))
+    first.start()
+    started.wait(5)
+    
+    # Si la primera no termina a tiempo, el duplicado recibe 409
+    with pytest.raises(HTTPException) as exc_info:
+        store.run("scope", "k", "hash", slow_operation)
+    assert exc_info.value.status_code == 409
+    release.set()
+    first.join(5)
+
+
+def test_idempotency_store_evicts_oldest_and_expired():
+    store = IdempotencyStore(max_keys=2, ttl=60)
+    store.run("scope", "a", "hash", lambda: "a")
+    store.run("scope", "b", "hash", lambda: "b")
+    store.run("scope", "c", "hash", lambda: "c")
+    
+    # La clave más antigua se expulsa al superar el límite
+    assert len(store) == 2
+    assert store.run("scope", "a", "hash", lambda: "a2") == ("a2", False)
+    
+    # Con TTL cero las respuestas expiran de inmediato
+    expired = IdempotencyStore(ttl=0)
+    expired.run("scope", "k", "hash", lambda: 1)
+    assert expired.run("scope", "k", "hash", lambda: 2) == (2, False)
+
+
+# ============ PRUEBAS DE ARCHIVADO DE TAREAS ============
+
+def _create_old_completed_task(session: Session, email: str):
+    user = services.create_user(UserCreate(name="Archivo", email=email), session)
+    task = services.create_task(TaskCreate(title="Vieja", user_id=user.id), session)
+    task.is_completed = True
+    task.created_at = datetime.now() - timedelta(days=90)
+    session.add(task)
+    session.commit()
+    return user, task
+
+
+def test_archive_moves_old_completed_tasks(session: Session):
+    user, task = _create_old_completed_task(session, "archivo@test.com")
+    user_id, task_id = user.id, task.id
+    services.create_task(TaskCreate(title="Pendiente", user_id=user_id), session)
+    
+    assert archive_completed_tasks(session, older_than_days=30, batch_size=1) == 1
+    
+    # La tabla principal solo conserva la pendiente, pero la archivada se sigue encontrando
+    assert len(services.list_user_tasks(user_id, session)) == 1
+    assert len(services.list_user_tasks(user_id, session, include_archived=True)) == 2
+    assert services.get_task(task_id, session).title == "Vieja"
+
+
+def test_update_archived_task_restores_it(session: Session):
+    user, task = _create_old_completed_task(session, "restaurar@test.com")
+    user_id, task_id = user.id, task.id
+    archive_completed_tasks(session, older_than_days=30)
+    
+    # Al modificar una tarea archivada vuelve a la tabla principal
+    updated = services.update_task(task_id, TaskUpdate(is_completed=False), session)
+    assert updated.is_completed is False
+    assert len(services.list_user_tasks(user_id, session)) == 1
+    
+    # Ya no quedan tareas completadas antiguas que archivar
+    assert archive_completed_tasks(session, older_than_days=30) == 0
+
+
+# ============ PRUEBAS DEL FILTRO DE USUARIOS ============
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(expected_items=1000, false_positive_rate=0.01)
+    for i in range(1000):
+        bloom.add(str(i))
+    
+    assert all(str(i) in bloom for i in range(1000))
+    assert bloom.estimated_false_positive_rate < 0.02
+    
+    # Los falsos positivos quedan cerca de la tasa configurada
+    false_positives = sum(str(i) in bloom for i in range(1000, 11000))
+    assert false_positives < 300
+
+
+def test_user_filter_answers_negatives_after_warm(session: Session, monkeypatch):
+    user = services.create_user(UserCreate(name="Filtro", email="filtro@test.com"), session)
+    user_filter = UserMembershipFilter(expected_users=100, enabled=True)
+    
+    # Sin llenar, el filtro no responde negativos
+    assert user_filter.might_have_user_id(999) is True
+    
+    user_filter.warm(session)
+    monkeypatch.setattr(services, "user_filter", user_filter)
+    assert user_filter.might_have_user_id(user.id) is True
+    assert user_filter.might_have_email("filtro@test.com") is True
+    
+    # Un usuario inexistente da 404 sin consultar la BD
+    with pytest.raises(HTTPException) as exc_info:
+        services.create_task(TaskCreate(title="Tarea", user_id=999), session)
+    assert exc_info.value.status_code == 404
+    
+    # Los usuarios nuevos se añaden al filtro y el email duplicado se sigue detectando
+    new_user = services.create_user(UserCreate(name="Nuevo", email="nuevo@test.com"), session)
+    assert user_filter.might_have_user_id(new_user.id) is True
+    with pytest.raises(HTTPException) as exc_info:
+        services.create_user(UserCreate(name="Nuevo", email="nuevo@test.com"), session)
+    assert exc_info.value.status_code == 400
+    assert user_filter.stats()["definite_negatives"] >= 1
+
+
+# ============ PRUEBAS DE SNAPSHOTS ============
+
+def test_export_snapshot_incremental(session: Session, tmp_path):
+    user = services.create_user(UserCreate(name="Analista", email="analista@test.com"), session)
+    services.create_task(TaskCreate(title="Primera", user_id=user.id), session)
+    
+    # El primer snapshot exporta todo y deja la marca
+    first = export_table(
+        session, "tasks", "parquet", incremental=True, directory=str(tmp_path), batch_size=1, safety_lag=0
+    )
+    assert first["rows"] == 1
+    assert pq.read_table(first["path"]).column("title").to_pylist() == ["Primera"]
+    
+    # El siguiente solo exporta las tareas nuevas
+    services.create_task(TaskCreate(title="Segunda", user_id=user.id), session)
+    second = export_table(session, "tasks", "arrow", incremental=True, directory=str(tmp_path), safety_lag=0)
+    assert second["rows"] == 1
+    with pa.ipc.open_file(second["path"]) as reader:
+        assert reader.read_all().column("title").to_pylist() == ["Segunda"]
+    
+    # Sin cambios el snapshot incremental queda vacío
+    assert export_table(session, "tasks", incremental=True, directory=str(tmp_path), safety_lag=0)["rows"] == 0
+
+
+def test_export_snapshot_users_always_full(session: Session, tmp_path):
+    services.create_user(UserCreate(name="Uno", email="uno-snap@test.com"), session)
+    export_table(session, "users", incremental=True, directory=str(tmp_path), safety_lag=0)
+    services.create_user(UserCreate(name="Dos", email="dos-snap@test.com"), session)
+    
+    # users no tiene marca: el incremental exporta la tabla completa
+    second = export_table(session, "users", incremental=True, directory=str(tmp_path), safety_lag=0)
+    assert second["incremental"] is False
+    assert second["rows"] == 2
+    assert read_watermark("users", str(tmp_path)) is None
+
+
+def test_export_snapshot_incremental_archive_uses_archived_at(session: Session, tmp_path):
+    user = _create_old_completed_task(session, "archivo-snap@test.com")[0]
+    archive_completed_tasks(session, older_than_days=30)
+    first = export_table(session, "tasks_archive", incremental=True, directory=str(tmp_path), safety_lag=0)
+    assert first["rows"] == 1
+    
+    # Una tarea más antigua completada después se archiva más tarde y no se pierde
+    older = services.create_task(TaskCreate(title="Muy vieja", user_id=user.id), session)
+    older.is_completed = True
+    older.created_at = datetime.now() - timedelta(days=200)
+    session.add(older)
+    session.commit()
+    archive_completed_tasks(session, older_than_days=30)
+    
+    second = export_table(session, "tasks_archive", incremental=True, directory=str(tmp_path), safety_lag=0)
+    assert second["rows"] == 1
+    assert pq.read_table(second["path"]).column("title").to_pylist() == ["Muy vieja"]
+
+
+def test_export_snapshot_incremental_safety_lag(session: Session, tmp_path):
+    user = services.create_user(UserCreate(name="Margen", email="margen@test.com"), session)
+    services.create_task(TaskCreate(title="Reciente", user_id=user.id), session)
+    
+    # Las filas más nuevas que el margen no se exportan ni mueven la marca
+    first = export_table(session, "tasks", incremental=True, directory=str(tmp_path), safety_lag=60)
+    assert first["rows"] == 0
+    assert read_watermark("tasks", str(tmp_path)) is None
+    
+    # Una fila confirmada tarde con una fecha anterior se exporta en el siguiente snapshot
+    late = Task(title="Tardía", user_id=user.id, created_at=datetime.now() - timedelta(seconds=120))
+    session.add(late)
+    session.commit()
+    second = export_table(session, "tasks", incremental=True, directory=str(tmp_path), safety_lag=60)
+    assert pq.read_table(second["path"]).column("title").to_pylist() == ["Tardía"]
+
+
+def test_concurrent_incremental_snapshots_do_not_duplicate(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'snap.db'}", connect_args={"timeout": 30})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        user = services.create_user(UserCreate(name="Snaps", email="snaps@test.com"), session)
+        for i in range(200):
+            session.add(Task(title=f"Tarea {i}", user_id=user.id, created_at=datetime.now() - timedelta(hours=1)))
+        session.commit()
+    
+    # Dos snapshots incrementales a la vez (como dos jobs en el pool)
+    rows = []
+    errors = []
+    
+    def exporter():
+        try:
+            with Session(engine) as session:
+                result = export_table(
+                    session, "tasks", incremental=True, directory=str(tmp_path), batch_size=1, safety_lag=0
+                )
+                rows.append(result["rows"])
+        except Exception as exc:
+            errors.append(exc)
+    
+    threads = [threading.Thread(target=exporter) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    # El segundo espera al primero y parte de su marca
+    assert errors == []
+    assert sorted(rows) == [0, 200]
+
+
+# ============ PRUEBAS DE JOBS ============
+
+def test_job_is_claimed_once_and_runs(session: Session):
+    user = services.create_user(UserCreate(name="Jobs", email="jobs@test.com"), session)
+    for i in range(3):
+        services.create_task(TaskCreate(title=f"Tarea {i}", user_id=user.id), session)
+    
+    job = jobs.enqueue_job(JobCreate(kind="delete_user_tasks", params={"user_id": user.id}), session)
+    assert job.status == "queued"
+    
+    # Solo un worker puede reclamar el job
+    assert jobs.claim_next_job(session) == job.id
+    assert jobs.claim_next_job(session) is None
+    
+    finished = jobs.run_job(job.id, session)
+    assert finished.status == "succeeded"
+    assert finished.progress == 1.0
+    assert jobs.job_to_read(finished).result == {"deleted": 3}
+    assert services.list_user_tasks(user.id, session) == []
+
+
+def test_archive_job_reports_progress(session: Session, monkeypatch):
+    for i in range(3):
+        _create_old_completed_task(session, f"progreso{i}@test.com")
+    
+    # El job usa el mismo bucle por lotes que el archivador e informa tras cada lote
+    reported = []
+    monkeypatch.setattr(jobs, "archive_completed_tasks", functools.partial(archive_completed_tasks, batch_size=2))
+    result = jobs.archive_job(session, jobs.ArchiveJobParams(older_than_days=30), reported.append)
+    
+    assert result == {"archived": 3}
+    assert reported == [2 / 3, 1.0]
+
+
+def test_job_failure_is_recorded(session: Session):
+    job = jobs.enqueue_job(JobCreate(kind="delete_user_tasks", params={"user_id": 999}), session)
+    jobs.claim_next_job(session)
+    
+    failed = jobs.run_job(job.id, session)
+    assert failed.status == "failed"
+    assert "Usuario no encontrado" in failed.error
+
+
+def test_enqueue_unknown_job_kind(session: Session):
+    with pytest.raises(HTTPException) as exc_info:
+        jobs.enqueue_job(JobCreate(kind="desconocido"), session)
+    
+    assert exc_info.value.status_code == 400
+
+
+def test_enqueue_validates_job_params(session: Session):
+    # Los parámetros se validan y se guardan normalizados ("false" es False)
+    job = jobs.enqueue_job(
+        JobCreate(kind="snapshot", params={"incremental": "false", "tables": ["users"]}), session
+    )
+    assert jobs.job_to_read(job).params == {"format": "parquet", "incremental": False, "tables": ["users"]}
+    
+    for params in ({"tables": ["no_existe"]}, {"format": "csv"}, {"incremental": "quizás"}):
+        with pytest.raises(HTTPException) as exc_info:
+            jobs.enqueue_job(JobCreate(kind="snapshot", params=params), session)
+        assert exc_info.value.status_code == 400
+    
+    with pytest.raises(HTTPException):
+        jobs.enqueue_job(JobCreate(kind="delete_user_tasks"), session)
+
+
+def test_archive_keeps_concurrent_update(session: Session):
+    task_id = _create_old_completed_task(session, "carrera@test.com")[1].id
+    cutoff = datetime.now() - timedelta(days=30)
+    ids = select_archivable_ids(session, cutoff)
+    assert ids == [task_id]
+    
+    # Un update_task entre la selección y la copia no se pierde
+    services.update_task(task_id, TaskUpdate(title="Editada"), session)
+    assert move_tasks(session, ids, cutoff) == 1
+    assert services.get_task(task_id, session).title == "Editada"
+    
+    # Si la tarea deja de estar completada, no se archiva
+    other_id = _create_old_completed_task(session, "carrera2@test.com")[1].id
+    ids = select_archivable_ids(session, cutoff)
+    services.update_task(other_id, TaskUpdate(is_completed=False), session)
+    assert move_tasks(session, ids, cutoff) == 0
+    assert services.get_task(other_id, session).is_completed is False
+
+
+def test_concurrent_archivers_do_not_duplicate(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'archivo.db'}", connect_args={"timeout": 30})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        user = services.create_user(UserCreate(name="Lotes", email="lotes@test.com"), session)
+        for i in range(50):
+            session.add(Task(
+                title=f"Tarea {i}", user_id=user.id, is_completed=True,
+                created_at=datetime.now() - timedelta(days=90)
+            ))
+        session.commit()
+    
+    # Dos archivadores a la vez sobre las mismas filas
+    moved = []
+    errors = []
+    
+    def archiver():
+        try:
+            with Session(engine) as session:
+                moved.append(archive_completed_tasks(session, older_than_days=30, batch_size=7))
+        except Exception as exc:
+            errors.append(exc)
+    
+    threads = [threading.Thread(target=archiver) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert errors == []
+    assert sum(moved) == 50
+    with Session(engine) as session:
+        assert session.exec(select(func.count()).select_from(TaskArchive)).one() == 50
+        assert session.exec(select(func.count()).select_from(Task)).one() == 0
+
+
+def test_only_one_process_starts_archiver(tmp_path):
+    lock_file = str(tmp_path / "archive.lock")
+    first = start_archive_worker(interval=3600, lock_file=lock_file)
+    try:
+        assert first is not None
+        # Con el bloqueo tomado, otro worker no inicia su propio archivador
+        assert start_archive_worker(interval=3600, lock_file=lock_file) is None
+    finally:
+        stop_archive_worker(first)
+    
+    # Al detenerse libera el bloqueo
+    again = start_archive_worker(interval=3600, lock_file=lock_file)
+    assert again is not None
+    stop_archive_worker(again)
+
+
+def test_archive_works_after_lifespan_without_thread(session: Session):
+    # Con el hilo desactivado (por defecto), arrancar y parar la app no detiene el archivado
+    stop_archive_worker(start_archive_worker(interval=0))
+    _create_old_completed_task(session, "sin_hilo@test.com")
+    
+    assert archive_completed_tasks(session, older_than_days=30) == 1
+
+
+def _crash_job(session, params, report):
+    time.sleep(0.2)
+    os._exit(1)
+
+
+def _slow_job(session, params, report):
+    time.sleep(0.5)
+    return {}
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="el test usa fork")
+def test_worker_survives_crashed_job(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}", connect_args={"timeout": 30})
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(jobs, "engine", engine)
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    monkeypatch.setitem(jobs.JOB_KINDS, "crash", (SQLModel, _crash_job))
+    monkeypatch.setitem(jobs.JOB_KINDS, "slow", (SQLModel, _slow_job))
+    
+    with Session(engine) as session:
+        crash_id = jobs.enqueue_job(JobCreate(kind="crash"), session).id
+        slow_id = jobs.enqueue_job(JobCreate(kind="slow"), session).id
+        archive_ids = [jobs.enqueue_job(JobCreate(kind="archive"), session).id for _ in range(2)]
+    
+    # El proceso del job muere: el worker sigue con el resto de la cola
+    jobs.run_worker(workers=2, poll_seconds=0.01, once=True)
+    
+    with Session(engine) as session:
+        crashed = jobs.get_job(crash_id, session)
+        assert crashed.status == "failed"
+        assert crashed.attempts == 2
+        assert "BrokenProcessPool" in crashed.error
+        # El job que corría a la vez no pierde intentos por la caída del otro
+        slow = jobs.get_job(slow_id, session)
+        assert (slow.status, slow.attempts) == ("succeeded", 1)
+        assert [jobs.get_job(job_id, session).status for job_id in archive_ids] == ["succeeded", "succeeded"]
+
+
+def test_schedule_archive_job(session: Session):
+    # Sin archivados previos se encola uno
+    job = jobs.schedule_archive_job(session, interval=3600)
+    assert job is not None and job.kind == "archive"
+    
+    # No se duplica mientras está pendiente ni antes de que pase el intervalo
+    assert jobs.schedule_archive_job(session, interval=3600) is None
+    job.status = "succeeded"
+    session.add(job)
+    session.commit()
+    assert jobs.schedule_archive_job(session, interval=3600) is None
+    
+    job.created_at = datetime.now() - timedelta(hours=2)
+    session.add(job)
+    session.commit()
+    assert jobs.schedule_archive_job(session, interval=3600) is not None
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="el test usa fork")
+def test_worker_archives_without_queued_jobs(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}", connect_args={"timeout": 30})
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(jobs, "engine", engine)
+    with Session(engine) as session:
+        _create_old_completed_task(session, "worker-archivo@test.com")
+    
+    # El worker encola el archivado por su cuenta
+    jobs.run_worker(workers=1, poll_seconds=0.01, once=True, archive_interval=3600)
+    
+    with Session(engine) as session:
+        assert session.exec(select(func.count()).select_from(Task)).one() == 0
+        assert session.exec(select(func.count()).select_from(TaskArchive)).one() == 1
+
+
+def test_requeue_stale_running_jobs(session: Session, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    stale = datetime.now() - timedelta(hours=1)
+    orphan = Job(kind="archive", status="running", attempts=1, heartbeat_at=stale)
+    exhausted = Job(kind="archive", status="running", attempts=2, heartbeat_at=stale)
+    alive = Job(kind="archive", status="running", attempts=1, heartbeat_at=datetime.now())
+    session.add_all([orphan, exhausted, alive])
+    session.commit()
+    
+    # Los jobs sin heartbeat vuelven a la cola o fallan si agotaron sus intentos
+    assert jobs.requeue_stale_jobs(session, lease_seconds=60) == 2
+    for job in (orphan, exhausted, alive):
+        session.refresh(job)
+    assert orphan.status == "queued"
+    assert exhausted.status == "failed"
+    assert alive.status == "running"